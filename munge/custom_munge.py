@@ -11,6 +11,10 @@ import subprocess
 import os
 import time
 import traceback
+import struct
+import zlib
+import math
+import numpy as np
 
 
 # Set debug to an integer if you only want to load a limited number of
@@ -24,6 +28,10 @@ genome_build = "hg38"
 # Where to store tmp files
 tmp_file = "/users/mgloud/projects/gwas/scripts/tmp/unsorted_GWAS.tmp"
 
+# Number of bins in the p-value histogram used to estimate the median
+# p-value for genomic control. Memory use doesn't depend on file size.
+qc_pval_bins = 10000
+
 def is_int(s):
     try:
         int(float(s))
@@ -66,6 +74,19 @@ def main():
         try:
             print "Munging", study["study_info"]
 
+            if "output_file" in study:
+                # This is only used in cases where we want to output multiple files under a single
+                # study's directory. This would usually happen if the study contains
+                # input files with different formats.
+                out_file = "{0}/GWAS_{1}.txt".format(config["output_base_dir"], study["output_file"])
+            else:
+                out_file = "{0}/GWAS_{1}.txt".format(config["output_base_dir"], study["study_info"])
+
+            # Remove any trait directory, trait-sorted copy and QC report from an
+            # earlier run, so that they can't be used with the new output file
+            subprocess.check_call(["rm", "-f", out_file+".gz.traits", out_file[:-len(".txt")] + ".qc.json",
+                "{0}/by_trait/{1}.gz".format(config["output_base_dir"], os.path.basename(out_file))])
+
             # Check if the config file specifies a custom delimiter
             delimiter = "\t"
             if "delimiter" in study:
@@ -79,6 +100,7 @@ def main():
             # Parse each input trait separately, but output them
             # all to the same final file.
             first_trait = True
+            study_qc = {}
             for trait in study["traits"]:
                 print "Current trait:", trait
 
@@ -124,6 +146,10 @@ def main():
                 # into a single data frame.
                 data = pd.concat(all_data)
 
+                # Keep track of QC statistics for this trait as we go
+                qc = new_qc()
+                qc["rows_read"] = data.shape[0]
+
                 # Note key SNP attributes
                 if "effect_index" in study:
                     data.rename(columns={data.keys()[int(study["effect_index"]) - 1]:'beta'}, inplace = True)
@@ -222,8 +248,10 @@ def main():
                     data["snp_pos"] = data["rsid"].apply(get_pos)
                 
                     # Throw away the ones with rsids not found
+                    before = data.shape[0]
                     data = data[~(data['chr'] == -1)]
                     data = data[~(data['snp_pos'] == -1)]
+                    qc["unmapped_rsids"] += before - data.shape[0]
                     
                     print "after merge"
                     print time.time() - lasttime
@@ -257,8 +285,10 @@ def main():
                         data = data[cols]
 
                     
+                    before = data.shape[0]
                     data = data[~(pd.isnull(data['chr']))]
                     data = data[~(pd.isnull(data['snp_pos']))]
+                    qc["missing_positions"] += before - data.shape[0]
                     data['chr'] = data['chr'].str.replace('chr', '')
                     data['snp_pos'] = data['snp_pos'].astype(float).astype(int)
     
@@ -305,8 +335,10 @@ def main():
                     data["snp_pos"] = data["rsid"].apply(get_pos)
                 
                     # Throw away the ones with rsids not found
+                    before = data.shape[0]
                     data = data[~(data['chr'] == -1)]
                     data = data[~(data['snp_pos'] == -1)]
+                    qc["unmapped_rsids"] += before - data.shape[0]
 
                     new_data = data
 
@@ -331,7 +363,9 @@ def main():
                         return True
                     except:
                         return False
+                before = new_data.shape[0]
                 new_data = new_data[new_data['pvalue'].apply(valid_pval)]
+                qc["invalid_pvalues"] += before - new_data.shape[0]
                 # Then reorder the new table appropriately
 
                 cols = new_data.columns.tolist()
@@ -396,6 +430,9 @@ def main():
 
                 print new_data.head(3)
 
+                update_qc(qc, new_data)
+                study_qc[trait] = qc
+
                 # Write header only if it's the first trait from this study
                 if first_trait:
                     with open(tmp_file, "w") as w:
@@ -407,13 +444,6 @@ def main():
                 first_trait = False
 
             # Sort the new table and write it to its final destination file
-            if "output_file" in study:
-                # This is only used in cases where we want to output multiple files under a single
-                # study's directory. This would usually happen if the study contains
-                # input files with different formats.
-                out_file = "{0}/GWAS_{1}.txt".format(config["output_base_dir"], study["output_file"])
-            else:
-                out_file = "{0}/GWAS_{1}.txt".format(config["output_base_dir"], study["study_info"])
             # TODO: This is unsafe. Fix it using Popen
             # TODO: This also probably isn't very efficient right now, so fix that if possible
             subprocess.check_call("head -n 1 {1} > {0}".format(out_file, tmp_file), shell=True)
@@ -430,6 +460,27 @@ def main():
                 subprocess.check_call(["tabix", "-f", "-s", "3", "-b", "4", "-e", "4", "-S", "1", out_file+".gz"])
             else:
                 subprocess.check_call(["tabix", "-f", "-s", "2", "-b", "3", "-e", "3", "-S", "1", out_file+".gz"])
+
+            # The output file has to be sorted by position for tabix, so the rows
+            # for different traits are mixed together. For multi-trait studies,
+            # we can also write a copy sorted by trait, along with a directory of where
+            # each trait starts and ends, so that one trait can be read without the others.
+            # This doubles the disk space used by the study, so it's only done if asked for.
+            trait_directory = config.get("trait_directories", "False")
+            if "trait_directory" in study:
+                trait_directory = study["trait_directory"]
+            if len(study["traits"]) > 1 and trait_directory == "True":
+                # Kept in a subdirectory so that it doesn't match wildcards for the main files
+                subprocess.check_call("mkdir -p {0}/by_trait".format(config["output_base_dir"]), shell=True)
+                by_trait_file = "{0}/by_trait/{1}".format(config["output_base_dir"], os.path.basename(out_file))
+                subprocess.check_call("head -n 1 {1} > {0}".format(by_trait_file, tmp_file), shell=True)
+                subprocess.check_call("tail -n +2 {1} | sort -k1,1 -k3,3 -k4,4n >> {0}".format(by_trait_file, tmp_file), shell=True)
+                subprocess.check_call(["bgzip", "-f", by_trait_file])
+                write_trait_directory(by_trait_file+".gz", out_file+".gz.traits", out_file+".gz")
+
+            # Only write the QC report once everything else has succeeded, so
+            # that a report always means the study was munged completely
+            write_qc_report(study_qc, out_file[:-len(".txt")] + ".qc.json")
         except Exception as e:
             # Log problems to an error file, then move on
             subprocess.check_call("mkdir -p output", shell=True)
@@ -440,6 +491,197 @@ def main():
             #error = str(e)
             #error = error + "\t" + traceback.format_exc().replace("\n", "NEWLINE").replace("\t", "TAB")
 
+    # Summarize QC for every study in the output directory, including any
+    # munged in previous runs
+    write_qc_summary(config["output_base_dir"])
+
+
+def new_qc():
+    return {"rows_read": 0, "unmapped_rsids": 0, "missing_positions": 0, "invalid_pvalues": 0, "rows_written": 0,
+            "effect_direction": {"+": 0, "-": 0}, "snps_per_chr": {},
+            "pval_histogram": np.zeros(qc_pval_bins, dtype=np.int64)}
+
+def update_qc(qc, new_data):
+
+    # Add the rows about to be written to the QC statistics. P-values go
+    # into a fixed-size histogram rather than being stored, so that the median
+    # can be estimated without keeping every p-value in memory.
+    qc["rows_written"] += new_data.shape[0]
+    pvalues = new_data['pvalue'].astype(float).values
+    qc["pval_histogram"] += np.histogram(pvalues, bins=qc_pval_bins, range=(0.0, 1.0))[0]
+
+    chr_counts = new_data['chr'].astype(str).value_counts()
+    for chrom in chr_counts.index:
+        qc["snps_per_chr"][chrom] = qc["snps_per_chr"].get(chrom, 0) + int(chr_counts[chrom])
+
+    if "effect_direction" in new_data.columns.values:
+        direction_counts = new_data['effect_direction'].value_counts()
+        for direction in ["+", "-"]:
+            if direction in direction_counts.index:
+                qc["effect_direction"][direction] += int(direction_counts[direction])
+
+def merge_qc(qcs):
+    total = new_qc()
+    for qc in qcs:
+        for key in ["rows_read", "unmapped_rsids", "missing_positions", "invalid_pvalues", "rows_written"]:
+            total[key] += qc[key]
+        for direction in ["+", "-"]:
+            total["effect_direction"][direction] += qc["effect_direction"][direction]
+        for chrom in qc["snps_per_chr"]:
+            total["snps_per_chr"][chrom] = total["snps_per_chr"].get(chrom, 0) + qc["snps_per_chr"][chrom]
+        total["pval_histogram"] += qc["pval_histogram"]
+    return total
+
+def histogram_median(histogram):
+
+    # Find the bin containing the median, then interpolate linearly within it
+    total = histogram.sum()
+    if total == 0:
+        return None
+    cumulative = np.cumsum(histogram)
+    i = int(np.searchsorted(cumulative, total / 2.0))
+    below = 0
+    if i > 0:
+        below = cumulative[i-1]
+    fraction = (total / 2.0 - below) * 1.0 / histogram[i]
+    return (i + fraction) / len(histogram)
+
+def lambda_gc(median_pvalue):
+
+    # Genomic control lambda is the median chi-squared statistic (1 df) divided
+    # by its expected value under the null. The upper tail probability of a
+    # chi-squared statistic x is erfc(sqrt(x/2)), which is decreasing in x, so
+    # we find the statistic for the median p-value by bisection.
+    if median_pvalue is None or median_pvalue <= 0:
+        return None
+    low, high = 0.0, 1000.0
+    for i in range(100):
+        mid = (low + high) / 2
+        if math.erfc(math.sqrt(mid / 2)) > median_pvalue:
+            low = mid
+        else:
+            high = mid
+    return ((low + high) / 2) / 0.45493642311957283
+
+def qc_report(qc):
+    report = dict([(k, qc[k]) for k in qc if k != "pval_histogram"])
+    median = histogram_median(qc["pval_histogram"])
+    report["median_pvalue"] = median
+    report["lambda_gc"] = lambda_gc(median)
+    report["frac_unmapped_rsids"] = None
+    report["frac_missing_positions"] = None
+    report["frac_invalid_pvalues"] = None
+    report["frac_positive_effect"] = None
+    if qc["rows_read"] > 0:
+        report["frac_unmapped_rsids"] = qc["unmapped_rsids"] * 1.0 / qc["rows_read"]
+        report["frac_missing_positions"] = qc["missing_positions"] * 1.0 / qc["rows_read"]
+    if qc["rows_written"] + qc["invalid_pvalues"] > 0:
+        report["frac_invalid_pvalues"] = qc["invalid_pvalues"] * 1.0 / (qc["rows_written"] + qc["invalid_pvalues"])
+    directions = qc["effect_direction"]["+"] + qc["effect_direction"]["-"]
+    if directions > 0:
+        report["frac_positive_effect"] = qc["effect_direction"]["+"] * 1.0 / directions
+    return report
+
+def write_qc_report(study_qc, report_file):
+    report = {"output_file": os.path.basename(report_file)[:-len(".qc.json")] + ".txt.gz",
+              "traits": dict([(t, qc_report(study_qc[t])) for t in study_qc]),
+              "total": qc_report(merge_qc(study_qc.values()))}
+    with open(report_file, "w") as w:
+        json.dump(report, w, indent=4, sort_keys=True)
+
+def write_qc_summary(output_base_dir):
+    columns = ["rows_read", "rows_written", "frac_unmapped_rsids", "frac_missing_positions", "frac_invalid_pvalues",
+               "median_pvalue", "lambda_gc", "frac_positive_effect"]
+    with open("{0}/qc_summary.txt".format(output_base_dir), "w") as w:
+        w.write("\t".join(["output_file", "trait", "n_chr"] + columns) + "\n")
+        for report_file in sorted(glob.glob("{0}/GWAS_*.qc.json".format(output_base_dir))):
+            with open(report_file) as f:
+                report = json.load(f)
+            rows = [("all", report["total"])]
+            if len(report["traits"]) > 1:
+                rows.extend(sorted(report["traits"].items()))
+            for trait, qc in rows:
+                w.write("\t".join([report["output_file"], trait, str(len(qc["snps_per_chr"]))] + \
+                        ["NA" if qc.get(c) is None else str(qc[c]) for c in columns]) + "\n")
+
+def write_trait_directory(by_trait_file, directory_file, gwas_file, checkpoint_interval=1000):
+
+    # Record the BGZF virtual offsets (compressed block offset << 16 | offset within
+    # the block) at which each trait, and each chromosome within each trait, starts
+    # and ends, along with row counts. Within each chromosome we also record a
+    # checkpoint every few rows, so that a region can be found without reading
+    # the whole chromosome. The mtime and size of the main output file are
+    # stored too, so that readers can tell if the directory is out of date.
+    traits = {}
+    current = None
+    last_voffset = 0
+
+    with open(by_trait_file, "rb") as f:
+        coffset = 0
+        partial = ""
+        header = None
+        while True:
+            block = f.read(18)
+            if len(block) < 18:
+                break
+            xlen = struct.unpack("<H", block[10:12])[0]
+            bsize = struct.unpack("<H", block[16:18])[0]
+            block += f.read(bsize + 1 - 18)
+            data = zlib.decompress(block[12+xlen:-8], -15)
+
+            uoffset = 0
+            while uoffset < len(data):
+                end = data.find("\n", uoffset)
+                if end == -1:
+                    if partial == "":
+                        line_voffset = (coffset << 16) | uoffset
+                    partial += data[uoffset:]
+                    break
+                if partial == "":
+                    line_voffset = (coffset << 16) | uoffset
+                line = partial + data[uoffset:end]
+                partial = ""
+                uoffset = end + 1
+
+                fields = line.split("\t")
+                if header is None:
+                    header = fields
+                    trait_index = header.index("trait")
+                    chr_index = header.index("chr")
+                    snp_pos_index = header.index("snp_pos")
+                    continue
+
+                trait, chrom = fields[trait_index], fields[chr_index]
+                if current != (trait, chrom):
+                    if current is not None:
+                        traits[current[0]]["chroms"][current[1]]["end"] = line_voffset
+                        if current[0] != trait:
+                            traits[current[0]]["end"] = line_voffset
+                    if trait not in traits:
+                        traits[trait] = {"start": line_voffset, "rows": 0, "chroms": {}}
+                    traits[trait]["chroms"][chrom] = {"start": line_voffset, "rows": 0, "checkpoints": []}
+                    current = (trait, chrom)
+
+                entry = traits[trait]["chroms"][chrom]
+                if entry["rows"] % checkpoint_interval == 0:
+                    entry["checkpoints"].append([int(fields[snp_pos_index]), line_voffset])
+                entry["rows"] += 1
+                traits[trait]["rows"] += 1
+
+            coffset += bsize + 1
+            if len(data) > 0:
+                last_voffset = coffset << 16
+
+    if current is not None:
+        traits[current[0]]["chroms"][current[1]]["end"] = last_voffset
+        traits[current[0]]["end"] = last_voffset
+
+    stat = os.stat(gwas_file)
+    with open(directory_file, "w") as w:
+        json.dump({"file": os.path.relpath(by_trait_file, os.path.dirname(directory_file)),
+                   "gwas_mtime": stat.st_mtime, "gwas_size": stat.st_size,
+                   "columns": {"trait": trait_index, "chr": chr_index, "snp_pos": snp_pos_index},
+                   "traits": traits}, w)
 
 def load_hg19_rsid_keys():
     return load_rsid_keys(rsid_to_pos_file="/users/mgloud/projects/gwas/data/sorted_1kg_matched_hg19_snp150.txt.gz", \
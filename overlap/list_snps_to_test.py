@@ -7,17 +7,25 @@
 # batch of jobs like this, just by specifying different config
 # parameters. Avoids need to maintain multiple scripts like this.
 
+import contextlib
 import glob
 import gzip
+import os
 import subprocess
 import sys
 import operator
+import array
+import bisect
+import numpy as np
 import pandas as pd
 sys.path.insert(0, '/users/mgloud/projects/brain_gwas/scripts')
 import SNP 
 import json
 from multiprocessing import Pool
+import threading
+import Queue
 import traceback
+import region_server
 
 if sys.version_info[0] < 3:
     from StringIO import StringIO
@@ -26,15 +34,51 @@ else:
 
 from scipy import stats
 
-config_file = sys.argv[1]
-if config_file == "":
+# To split a run across several independent jobs, add "--shard i/N" to the command
+# line, where i is between 1 and N. Once all N jobs are done, run
+#   python list_snps_to_test.py merge config_file N
+# to combine the per-shard output files.
+args = sys.argv[1:]
+shard = None
+if "--shard" in args:
+    shard_arg = args.index("--shard")
+    try:
+        shard = tuple([int(x) for x in args[shard_arg+1].split("/")])
+    except (IndexError, ValueError):
+        shard = ()
+    del args[shard_arg:shard_arg+2]
+    if len(shard) != 2 or shard[0] < 1 or shard[0] > shard[1]:
+        print "Shard must be of the form i/N with 1 <= i <= N."
+        sys.exit()
+
+merge = len(args) > 0 and args[0] == "merge"
+if merge:
+    args = args[1:]
+    if len(args) < 2:
+        print "Usage: python list_snps_to_test.py merge config_file N"
+        sys.exit()
+
+if len(args) == 0 or args[0] == "":
     print "Please specify a config file."
     sys.exit()
-
-max_threads = 1
-if len(sys.argv) > 2:
-    max_threads = int(sys.argv[2])
-print max_threads
+config_file = args[0]
+
+# The optional second argument caps the number of query threads when the
+# config sets "executor": "threads"
+max_threads = 64
+num_shards = 1
+if merge and len(args) > 1:
+    num_shards = int(args[1])
+elif len(args) > 1:
+    max_threads = int(args[1])
+
+# Approximate chromosome lengths (hg19), used to estimate how much
+# of a GWAS file's work falls on each chromosome when sharding.
+chrom_lengths = {"1": 249250621, "2": 243199373, "3": 198022430, "4": 191154276, "5": 180915260,
+                 "6": 171115067, "7": 159138663, "8": 146364022, "9": 141213431, "10": 135534747,
+                 "11": 135006516, "12": 133851895, "13": 115169878, "14": 107349540, "15": 102531392,
+                 "16": 90354753, "17": 81195210, "18": 78077248, "19": 59128983, "20": 63025520,
+                 "21": 48129895, "22": 51304566, "X": 155270560, "Y": 59373566}
 
 def main():
 
@@ -42,6 +86,21 @@ def main():
     
     # Load config file
     config = load_config(config_file)
+    if config.get("executor", "processes") == "threads":
+        print "Running at most {0} query threads".format(max_threads)
+
+    if merge:
+        merge_shards(config, num_shards)
+        return
+
+    # In shard mode, only test the (GWAS file, chromosome) pairs assigned to
+    # this shard, and write to separate output files to be merged later.
+    if shard is not None:
+        fingerprint = shard_fingerprint(config)
+        assignments = assign_shards(config, shard[1])
+        config["output_base"] = shard_output_base(config, shard[0], shard[1])
+        with open(fingerprint_file(config, config["output_base"]), "w") as w:
+            json.dump(fingerprint, w, indent=4, sort_keys=True)
  
     # Write headers
     for gwas_group in config["gwas_groups"]:
@@ -70,12 +129,19 @@ def main():
                 # Get the GWAS SNPs to test for this parameter specification
                 for gwas_file in gwas_files:
 
+                    chroms = None
+                    if shard is not None:
+                        chroms = assignments[shard[0]-1].get((gwas_group, gwas_file), [])
+                        if len(chroms) == 0:
+                            continue
+
                     print gwas_file 
 
-                    info = snps_by_threshold(gwas_file, gwas_cutoff_pval, gwas_file, config, window=gwas_window)
+                    info = snps_by_threshold(gwas_file, gwas_cutoff_pval, gwas_file, config, window=gwas_window, chroms=chroms, traits=config["gwas_groups"][gwas_group].get("traits"))
 
                     # Run SNPs in parallel across multiple threads
                     for snp in info:
+                        snp = snp_tuple(snp)
                         with open("{0}/{1}_{4}_gwas-pval{2}_gwas-window{3}_snps-considered.txt".format(config["output_directory"], config["output_base"], gwas_cutoff_pval, gwas_window, gwas_group), "a") as a:
                             a.write("\t".join([str(s) for s in snp]) + "\t" + gwas_file + "\n")
                     for eqtl_group in config["gwas_groups"][gwas_group]["eqtl_targets"]:
@@ -89,23 +155,141 @@ def main():
 
 def add_snps_to_test(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files):
 
+        if config.get("executor", "processes") == "threads":
+            add_snps_to_test_threaded(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files)
+            return
+
+        # Workers are forked after the candidates are stored here, so each task
+        # only needs to be sent the index of its SNP rather than a copy of the data.
+        global candidates
+        candidates = info
+
         pool = Pool()
-        for snp in info:
+        for i in range(len(info)):
             for pheno in eqtl_files:
-                pool.apply_async(test_wrapper, args=(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files, snp, pheno))
+                pool.apply_async(test_wrapper, args=(config, None, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files, i, pheno))
         pool.close()
         pool.join()
 
-def test_wrapper(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files, snp, pheno):
+def add_snps_to_test_threaded(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files):
+
+    # Each test spends most of its time waiting on zcat and tabix, so on
+    # slow shared filesystems it's faster to keep many queries going at once
+    # in threads than to wait on one query at a time in each pool process.
+    # A fixed set of at most max_threads threads takes tests from a shared
+    # queue, in turn across the eQTL files, and a semaphore for each file
+    # keeps at most "queries_in_flight" queries running against it. All results
+    # go through a single writer thread; if it falls behind, the bounded
+    # queue makes the query threads wait. If writing fails, the writer keeps
+    # emptying the queue so that nothing waits forever, and the error is
+    # raised here once all the threads have finished.
+    in_flight = int(config.get("queries_in_flight", 8))
+    results = Queue.Queue(maxsize=int(config.get("write_queue_size", 1000)))
+
+    write_errors = []
+    writer = threading.Thread(target=result_writer, args=(results, write_errors))
+    writer.start()
+
+    limits = {}
+    for pheno in eqtl_files:
+        limits[pheno] = threading.BoundedSemaphore(in_flight)
+    tests = Queue.Queue()
+    for snp in info:
+        for pheno in eqtl_files:
+            tests.put((snp_tuple(snp), pheno))
+
+    workers = []
+    for i in range(min(max_threads, in_flight * len(eqtl_files))):
+        worker = threading.Thread(target=thread_worker, args=(tests, limits, results, config, None, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files))
+        worker.start()
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+    results.put(None)
+    writer.join()
+    if len(write_errors) > 0:
+        raise write_errors[0][0], write_errors[0][1], write_errors[0][2]
+
+def thread_worker(tests, limits, results, config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files):
+    while True:
+        try:
+            snp, pheno = tests.get_nowait()
+        except Queue.Empty:
+            return
+        output = []
+        try:
+            with limits[pheno]:
+                test_snp(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files, snp, pheno, output)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+        if len(output) > 0:
+            results.put(output)
+
+def result_writer(results, write_errors):
+    # Keep the output files open for the whole batch rather than
+    # re-opening them for every line. After the first error, stop writing
+    # but keep taking results off the queue so the query threads can finish.
+    files = {}
+    while True:
+        output = results.get()
+        if output is None:
+            break
+        if len(write_errors) > 0:
+            continue
+        try:
+            for filename, line in output:
+                if filename not in files:
+                    files[filename] = open(filename, "a")
+                files[filename].write(line)
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            write_errors.append(sys.exc_info())
+    for f in files.values():
+        try:
+            f.close()
+        except Exception:
+            if len(write_errors) == 0:
+                write_errors.append(sys.exc_info())
+
+def test_wrapper(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files, snp_index, pheno):
     try:
+        snp = snp_tuple(candidates[snp_index])
         test_snp(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files, snp, pheno)
     except Exception:
         traceback.print_exc(file=sys.stdout)
 
 
-def test_snp(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files, snp, pheno):
-    # Get header to locate columns of interest
-    header = subprocess.check_output("zcat {0} 2> /dev/null | head -n 1".format(pheno), shell=True).strip().split("\t")
+def test_snp(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file, eqtl_group, eqtl_cutoff_pval, eqtl_window, eqtl_files, snp, pheno, output=None):
+
+    # If an output list is given, collect (filename, line) pairs in it
+    # instead of appending to the output files directly.
+    def write(filename, line):
+        if output is None:
+            with open(filename, "a") as a:
+                a.write(line)
+        else:
+            output.append((filename, line))
+
+    # Optionally, only consider some of the traits in multi-trait files
+    traits = config["eqtl_groups"][eqtl_group].get("traits")
+    region = "{0}:{1}-{2}".format(snp[0], snp[1]-eqtl_window, snp[1]+eqtl_window)
+
+    # Get header to locate columns of interest. With a region server, get the
+    # header and the region (spelled both with and without "chr") in a single
+    # request, rather than paying for a round trip for each one.
+    wide_matches = None
+    chr_matches = None
+    if "region_server" in config:
+        # Only ask for single traits from files with a trait directory;
+        # otherwise the server would send every line once for each trait
+        batch_traits = traits
+        if traits is not None and region_server.load_trait_directory(pheno) is None:
+            batch_traits = None
+        header, (wide_matches, chr_matches) = region_server.remote_tabix_batch(config["region_server"], pheno, [region, "chr" + region], batch_traits)
+        header = header.strip().split("\t")
+    else:
+        header = subprocess.check_output("zcat {0} 2> /dev/null | head -n 1".format(pheno), shell=True, close_fds=True).strip().split("\t")
     header = [h.lower() for h in header]
     pval_index = header.index("pvalue")
     if "swap" in config and config["swap"] == "True":
@@ -118,15 +302,22 @@ def test_snp(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file,
     else:
         gene_index = header.index("feature")
   
-    wide_matches = subprocess.check_output("tabix {0} {1}:{2}-{3}".format(pheno, snp[0], snp[1]-eqtl_window, snp[1]+eqtl_window), shell=True)
+    if wide_matches is None:
+        wide_matches = tabix(config, pheno, region, traits)
     if wide_matches == "":
-        wide_matches = subprocess.check_output("tabix {0} {1}:{2}-{3}".format(pheno, "chr"+str(snp[0]), snp[1]-eqtl_window, snp[1]+eqtl_window), shell=True)
+        if chr_matches is None:
+            chr_matches = tabix(config, pheno, "chr" + region, traits)
+        wide_matches = chr_matches
         if wide_matches == "":
             return
     
     # Sort by pval so we can be sure we get the most significant SNP at the locus first
     wide_matches = wide_matches.strip().split("\n")
     wide_matches = [wm.split("\t") for wm in wide_matches]
+    if traits is not None and "trait" in header:
+        wide_matches = [wm for wm in wide_matches if wm[header.index("trait")] in traits]
+        if len(wide_matches) == 0:
+            return
 
     def numerize_pval(x):
         new = x[:]
@@ -148,27 +339,42 @@ def test_snp(config, info, gwas_group, gwas_cutoff_pval, gwas_window, gwas_file,
         if gene_index != -1:
             # Keep track of all SNP-gene pairs considered, for the manuscript
             if data[gene_index] not in genes_considered:
-                with open("{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_snp-gene-pairs-considered.txt".format(config["output_directory"], config["output_base"], gwas_cutoff_pval, eqtl_cutoff_pval, gwas_window, eqtl_window, gwas_group, eqtl_group), "a") as a:
-                    a.write("\t".join([str(s) for s in snp]) + "\t" + str(data[pval_index]) + "\t" + gwas_file + "\t" + data[gene_index] + "\t" + pheno + "\n")
-                    genes_considered.add(data[gene_index])
+                write("{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_snp-gene-pairs-considered.txt".format(config["output_directory"], config["output_base"], gwas_cutoff_pval, eqtl_cutoff_pval, gwas_window, eqtl_window, gwas_group, eqtl_group), "\t".join([str(s) for s in snp]) + "\t" + str(data[pval_index]) + "\t" + gwas_file + "\t" + data[gene_index] + "\t" + pheno + "\n")
+                genes_considered.add(data[gene_index])
 
             if float(data[pval_index]) <= eqtl_cutoff_pval and data[gene_index] not in matched:
-                with open("{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_coloc-tests.txt".format(config["output_directory"], config["output_base"], gwas_cutoff_pval, eqtl_cutoff_pval, gwas_window, eqtl_window, gwas_group, eqtl_group), "a") as a:
-                    a.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\n".format(snp[0], snp[1], gwas_file, pheno, snp[3], snp[2], data[pval_index], data[gene_index]))
-                    matched.add(data[gene_index])
+                write("{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_coloc-tests.txt".format(config["output_directory"], config["output_base"], gwas_cutoff_pval, eqtl_cutoff_pval, gwas_window, eqtl_window, gwas_group, eqtl_group), "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\n".format(snp[0], snp[1], gwas_file, pheno, snp[3], snp[2], data[pval_index], data[gene_index]))
+                matched.add(data[gene_index])
         else:
             # Keep track of all SNP-gene pairs considered, for the manuscript
             if pheno not in genes_considered:
-                with open("{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_snp-gene-pairs-considered.txt".format(config["output_directory"], config["output_base"], gwas_cutoff_pval, eqtl_cutoff_pval, gwas_window, eqtl_window, gwas_group, eqtl_group), "a") as a:
-                    a.write("\t".join([str(s) for s in snp]) + "\t" + str(data[pval_index]) + "\t" + gwas_file + "\t" + pheno + "\t" + pheno + "\n")
-                    genes_considered.add(pheno)
+                write("{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_snp-gene-pairs-considered.txt".format(config["output_directory"], config["output_base"], gwas_cutoff_pval, eqtl_cutoff_pval, gwas_window, eqtl_window, gwas_group, eqtl_group), "\t".join([str(s) for s in snp]) + "\t" + str(data[pval_index]) + "\t" + gwas_file + "\t" + pheno + "\t" + pheno + "\n")
+                genes_considered.add(pheno)
 
             if float(data[pval_index]) <= eqtl_cutoff_pval and pheno not in matched:
-                with open("{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_coloc-tests.txt".format(config["output_directory"], config["output_base"], gwas_cutoff_pval, eqtl_cutoff_pval, gwas_window, eqtl_window, gwas_group, eqtl_group), "a") as a:
-                    a.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\n".format(snp[0], snp[1], gwas_file, pheno, snp[3], snp[2], data[pval_index], pheno))
-                    matched.add(pheno)
-
-def snps_by_threshold(gwas_file, gwas_threshold, default_trait, config, window=1000000):
+                write("{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_coloc-tests.txt".format(config["output_directory"], config["output_base"], gwas_cutoff_pval, eqtl_cutoff_pval, gwas_window, eqtl_window, gwas_group, eqtl_group), "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\n".format(snp[0], snp[1], gwas_file, pheno, snp[3], snp[2], data[pval_index], pheno))
+                matched.add(pheno)
+
+def tabix(config, filename, region, traits=None):
+    # If we only want some of the traits in a multi-trait file, read them
+    # directly from the copy sorted by trait, if there is one.
+    if traits is not None and region_server.load_trait_directory(filename) is not None:
+        if "region_server" in config:
+            return region_server.remote_trait_tabix(config["region_server"], filename, region, traits)
+        return "".join([line + "\n" for trait in traits for line in region_server.query_trait_region(trait_cache, filename, trait, region)])
+
+    # Use the local region server if one is specified, since it keeps
+    # indexes and hot blocks cached between queries
+    if "region_server" in config:
+        return region_server.remote_tabix(config["region_server"], filename, region)
+    return subprocess.check_output("tabix {0} {1}".format(filename, region), shell=True, close_fds=True)
+
+def snps_by_threshold(gwas_file, gwas_threshold, default_trait, config, window=1000000, chroms=None, traits=None):
+
+    # If chroms is given, only SNPs on those chromosomes are considered. Since
+    # lead SNPs are only ever clumped with other SNPs on the same chromosome,
+    # this gives the same results for those chromosomes as scanning the whole file.
+    # Likewise, if traits is given, only SNPs for those traits are considered.
 
     trait = default_trait
 
@@ -178,6 +384,8 @@ def snps_by_threshold(gwas_file, gwas_threshold, default_trait, config, window=1
     with gzip.open(gwas_file) as f:
         header = f.readline().strip().split()
 
+    with open_gwas_lines(gwas_file, chroms, traits) as f:
+
         trait_index = -1
         if "swap" in config and config["swap"] == "True":
             if "gene" in header:
@@ -190,7 +398,12 @@ def snps_by_threshold(gwas_file, gwas_threshold, default_trait, config, window=1
         chr_index = header.index("chr")
         snp_pos_index = header.index("snp_pos")
 
-        all_snps = []
+        # Store candidates in compact arrays rather than as a list of
+        # tuples, since loose cutoffs can give millions of them.
+        snp_chroms = array.array("h")
+        snp_positions = array.array("l")
+        snp_pvalues = array.array("d")
+        snp_traits = array.array("i")
 
         #i = 0
         for line in f:
@@ -200,6 +413,8 @@ def snps_by_threshold(gwas_file, gwas_threshold, default_trait, config, window=1
             data = line.strip().split("\t")
             if trait_index != -1:
                 trait = data[trait_index]
+                if traits is not None and trait not in traits:
+                    continue
             try:
                 pvalue = float(data[pval_index])
             except:
@@ -210,41 +425,263 @@ def snps_by_threshold(gwas_file, gwas_threshold, default_trait, config, window=1
             if pvalue > gwas_threshold:
                 continue
 
-            all_snps.append((chr, pos, pvalue, trait))
-    
-    # For now, include only autosomal SNPs.
-    filtered = []
-    for s in all_snps:
-        if "chr" in str(s[0]):
-            filtered.append((s[0][3:], s[1], s[2], s[3]))
-        else:
-            filtered.append((s[0], s[1], s[2], s[3]))
-
-    all_snps = sorted(filtered, key=operator.itemgetter(2)) 
+            snp_chroms.append(chrom_code(chr))
+            snp_positions.append(pos)
+            snp_pvalues.append(pvalue)
+            snp_traits.append(trait_code(trait))
+
+    # Read each array back with the C type it was built with, since the size
+    # of "l" (C long) depends on the platform, then convert to the fixed-size
+    # fields of candidate_dtype.
+    all_snps = np.zeros(len(snp_pvalues), dtype=candidate_dtype)
+    all_snps["chr"] = np.frombuffer(snp_chroms, dtype=np.dtype("h"))
+    all_snps["pos"] = np.frombuffer(snp_positions, dtype=np.dtype("l"))
+    all_snps["pvalue"] = np.frombuffer(snp_pvalues, dtype=np.dtype("d"))
+    all_snps["trait"] = np.frombuffer(snp_traits, dtype=np.dtype("i"))
+
+    # Stable sort, so that SNPs with equal p-values stay in file order
+    all_snps = all_snps[np.argsort(all_snps["pvalue"], kind="mergesort")]
+
+    # For now, ignore a SNP if it's in the MHC region -- this
+    # would require alternative methods.
+    if "6" in chrom_codes:
+        mhc = (all_snps["chr"] == chrom_codes["6"]) & (all_snps["pos"] > 25000000) & (all_snps["pos"] < 35000000)
+        all_snps = all_snps[~mhc]
 
     # Go through the list of SNPs in order, adding the ones
     # passing our criteria.
-    snps_to_test = []
-    for snp in all_snps:
+    # Before adding a SNP, make sure it's not right next
+    # to another SNP that we've already selected. Selected positions
+    # are kept sorted for each (chr, trait), so we only need to check
+    # the nearest selected SNP on either side. The columns are converted to
+    # lists first, since indexing NumPy arrays one element at a time is slow.
+    candidate_pos = all_snps["pos"].tolist()
+    candidate_chr = all_snps["chr"].tolist()
+    candidate_trait = all_snps["trait"].tolist()
+    kept = []
+    kept_positions = {}
+    for i in range(len(candidate_pos)):
+        pos = candidate_pos[i]
+        nearby = kept_positions.setdefault((candidate_chr[i], candidate_trait[i]), [])
+        j = bisect.bisect_left(nearby, pos)
+        if j < len(nearby) and nearby[j] - pos < window:
+            continue
+        if j > 0 and pos - nearby[j-1] < window:
+            continue
+        nearby.insert(j, pos)
+        kept.append(i)
+
+    snps_to_test = all_snps[kept]
+    return(snps_to_test)
 
-        # For now, ignore a SNP if it's in the MHC region -- this
-        # would require alternative methods.
-        if (snp[0] == "6") and snp[1] > 25000000 and snp[1] < 35000000:
-                continue
+# Chromosomes and traits of candidate SNPs are stored as integer codes,
+# shared by every file in the run. The tables must be filled in before
+# starting the worker processes, which happens since snps_by_threshold
+# is always called first.
+candidate_dtype = np.dtype([("chr", np.int16), ("pos", np.int64), ("pvalue", np.float64), ("trait", np.int32)])
+chrom_names = []
+chrom_codes = {}
+trait_names = []
+trait_codes = {}
+candidates = None
+
+# Block cache for reading single traits from multi-trait files
+trait_cache = region_server.BlockCache(64 * 1024 * 1024)
+
+def chrom_code(chrom):
+    if chrom not in chrom_codes:
+        # Strip the "chr" prefix, so that "chr1" and "1" get the same code
+        name = chrom
+        if "chr" in name:
+            name = name[3:]
+        if name not in chrom_codes:
+            chrom_codes[name] = len(chrom_names)
+            chrom_names.append(name)
+        chrom_codes[chrom] = chrom_codes[name]
+    return chrom_codes[chrom]
+
+def trait_code(trait):
+    if trait not in trait_codes:
+        trait_codes[trait] = len(trait_names)
+        trait_names.append(trait)
+    return trait_codes[trait]
+
+def snp_tuple(snp):
+    # Convert a candidate back to a (chr, pos, pvalue, trait) tuple
+    return (chrom_names[snp["chr"]], int(snp["pos"]), float(snp["pvalue"]), trait_names[snp["trait"]])
+
+
+def open_gwas_lines(gwas_file, chroms=None, traits=None):
+
+    # Open a GWAS file for reading past the header, either for the whole file
+    # or using tabix to read only the given chromosomes. If only some traits
+    # are wanted and the file has a trait directory, read just those traits.
+    if traits is not None and region_server.load_trait_directory(gwas_file) is not None:
+        def lines():
+            for trait in traits:
+                for chrom in (chroms or [None]):
+                    for line in region_server.read_trait_lines(trait_cache, gwas_file, trait, chrom):
+                        yield line
+        return contextlib.closing(lines())
+    if chroms is None:
+        f = gzip.open(gwas_file)
+        f.readline()
+        return f
+    return TabixReader([gwas_file] + list(chroms))
+
+class TabixReader:
+
+    # Lines of output from a tabix process. When closed, waits for the process
+    # to exit and raises an error if tabix failed (e.g. a missing or stale index),
+    # so that a failed read is never mistaken for a chromosome with no SNPs.
+    # tabix's error messages go to our own stderr.
+
+    def __init__(self, args):
+        self.args = ["tabix"] + args
+        self.process = subprocess.Popen(self.args, stdout=subprocess.PIPE, close_fds=True)
+
+    def __iter__(self):
+        return iter(self.process.stdout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't hide the original error; just clean up the process
+            self.process.stdout.close()
+            self.process.wait()
+
+    def close(self):
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, " ".join(self.args))
+
+def file_chroms(gwas_file):
+    return subprocess.check_output(["tabix", "-l", gwas_file], close_fds=True).strip().split("\n")
+
+def assign_shards(config, num_shards):
+
+    # Split the work into (GWAS file, chromosome) units and assign them to shards,
+    # largest first, each going to the shard with the least work so far.
+    # Cost is estimated from the file size, divided between chromosomes by length.
+    # Every shard job computes the same assignment, so it must be deterministic.
+    units = []
+    for gwas_group in sorted(config["gwas_groups"].keys()):
+        group = config["gwas_groups"][gwas_group]
+        gwas_files = []
+        for gwas_file in group["files"]:
+            gwas_files.extend(glob.glob(gwas_file))
+        passes = len(group["gwas_cutoff_pvals"]) * len(group["gwas_windows"])
+
+        for gwas_file in sorted(set(gwas_files)):
+            chroms = [c for c in file_chroms(gwas_file) if c != ""]
+            lengths = [chrom_lengths.get(c.replace("chr", ""), 1000000) for c in chroms]
+            size = os.path.getsize(gwas_file)
+            for chrom, length in zip(chroms, lengths):
+                cost = passes * size * 1.0 * length / sum(lengths)
+                units.append((cost, gwas_group, gwas_file, chrom))
+
+    units.sort(key=lambda u: (-u[0], u[1], u[2], u[3]))
+
+    loads = [0.0] * num_shards
+    assignments = [{} for i in range(num_shards)]
+    for cost, gwas_group, gwas_file, chrom in units:
+        i = loads.index(min(loads))
+        loads[i] += cost
+        assignments[i].setdefault((gwas_group, gwas_file), []).append(chrom)
+    return assignments
+
+def shard_output_base(config, i, num_shards):
+    return "{0}_shard{1}of{2}".format(config["output_base"], i, num_shards)
+
+def shard_fingerprint(config):
+
+    # Shard jobs may start at different times, and each one works out the
+    # assignment from the files on disk when it starts. Record the GWAS files
+    # it saw, so that merge can check all shards worked from the same files.
+    fingerprint = {}
+    for gwas_group in sorted(config["gwas_groups"].keys()):
+        gwas_files = []
+        for gwas_file in config["gwas_groups"][gwas_group]["files"]:
+            gwas_files.extend(glob.glob(gwas_file))
+        fingerprint[gwas_group] = []
+        for gwas_file in sorted(set(gwas_files)):
+            stat = os.stat(gwas_file)
+            fingerprint[gwas_group].append([gwas_file, stat.st_size, stat.st_mtime])
+    return fingerprint
+
+def fingerprint_file(config, shard_base):
+    return "{0}/{1}_fingerprint.json".format(config["output_directory"], shard_base)
+
+def merge_shards(config, num_shards):
+
+    # Combine the output files from every shard into files with the same lines
+    # that a single run would have produced. The snps-considered files are sorted
+    # by GWAS file, then p-value, as in a single run. Ties on p-value are broken by
+    # chromosome and position, since the shards don't record the original file
+    # order, so they may come out in a different order than in a single run.
+    # The other two files are written in no fixed order by a single run, so
+    # they're sorted by line to make the merged output deterministic.
+    shard_bases = [shard_output_base(config, i, num_shards) for i in range(1, num_shards+1)]
+
+    # Refuse to merge shards that didn't all see the same GWAS files, since
+    # they won't agree on which (file, chromosome) pairs each one ran
+    fingerprints = []
+    for shard_base in shard_bases:
+        if not os.path.exists(fingerprint_file(config, shard_base)):
+            raise Exception("Missing fingerprint from shard: {0}".format(fingerprint_file(config, shard_base)))
+        with open(fingerprint_file(config, shard_base)) as f:
+            fingerprints.append(json.load(f))
+    for i in range(1, num_shards):
+        if fingerprints[i] != fingerprints[0]:
+            raise Exception("Shards {0} and {1} were run on different GWAS files (added, removed or re-munged in between); re-run all shards before merging".format(shard_bases[0], shard_bases[i]))
 
-        # Before adding a SNP, make sure it's not right next
-        # to another SNP that we've already selected.
-        
-        skip = False
-        for kept_snp in snps_to_test:
-                if kept_snp[0] == snp[0] and abs(kept_snp[1] - snp[1]) < window and kept_snp[3] == snp[3]:
-                        skip = True
-                        break
-        if not skip:
-            snps_to_test.append(snp)
-            
-    return(snps_to_test)
+    for gwas_group in config["gwas_groups"]:
+        gwas_files = []
+        for gwas_file in config["gwas_groups"][gwas_group]["files"]:
+            gwas_files.extend(glob.glob(gwas_file))
+        file_order = dict([(f, i) for i, f in reversed(list(enumerate(gwas_files)))])
+
+        def snp_order(line):
+            data = line.rstrip("\n").split("\t")
+            return (file_order.get(data[-1], len(file_order)), float(data[2]), data[0], int(data[1]))
+
+        for gwas_cutoff_pval in config["gwas_groups"][gwas_group]["gwas_cutoff_pvals"]:
+            for gwas_window in config["gwas_groups"][gwas_group]["gwas_windows"]:
+                name = "{0}/{1}_{4}_gwas-pval{2}_gwas-window{3}_snps-considered.txt"
+                merge_shard_files(config, name, shard_bases, (gwas_cutoff_pval, gwas_window, gwas_group), snp_order)
+                for eqtl_group in config["gwas_groups"][gwas_group]["eqtl_targets"]:
+                    for eqtl_cutoff_pval in config["gwas_groups"][gwas_group]["eqtl_targets"][eqtl_group]["cutoff_pvals"]:
+                        for eqtl_window in config["gwas_groups"][gwas_group]["eqtl_targets"][eqtl_group]["windows"]:
+                            params = (gwas_cutoff_pval, eqtl_cutoff_pval, gwas_window, eqtl_window, gwas_group, eqtl_group)
+                            name = "{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_coloc-tests.txt"
+                            merge_shard_files(config, name, shard_bases, params, None)
+                            name = "{0}/{1}_{6}_{7}_gwas-pval{2}_eqtl-pval{3}_gwas-window{4}_eqtl-window{5}_snp-gene-pairs-considered.txt"
+                            merge_shard_files(config, name, shard_bases, params, None)
+
+def merge_shard_files(config, name, shard_bases, params, order):
+    header = None
+    lines = []
+    for shard_base in shard_bases:
+        shard_file = name.format(config["output_directory"], shard_base, *params)
+        if not os.path.exists(shard_file):
+            raise Exception("Missing output file from shard: {0}".format(shard_file))
+        with open(shard_file) as f:
+            header = f.readline()
+            lines.extend(f.readlines())
+
+    if order is None:
+        lines.sort()
+    else:
+        lines.sort(key=order)
 
+    with open(name.format(config["output_directory"], config["output_base"], *params), "w") as w:
+        w.write(header)
+        w.writelines(lines)
 
 def load_config(filename):
 
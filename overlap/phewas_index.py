@@ -0,0 +1,291 @@
+#!/usr/bin/python
+
+# Combined position index over all munged GWAS in a collection.
+#
+# Running list_snps_to_test.py with "swap": "True" runs a tabix query for every
+# (lead SNP, GWAS file) pair, which gets slow once there are hundreds of GWAS.
+# Instead, this script collects every SNP below a p-value ceiling from each
+# GWAS_*.txt.gz in the munge "output_base_dir" into a single store with one
+# position-sorted file per chromosome. A batch of positions can then be checked
+# against every study at once in a single pass through each chromosome file.
+#
+# Usage:
+#
+#   python phewas_index.py build munge_menu.config index_dir [pvalue_ceiling]
+#   python phewas_index.py update munge_menu.config index_dir
+#   python phewas_index.py query index_dir chr:pos window cutoff
+#
+# "update" re-indexes only the studies whose munged file has changed since
+# the last build (e.g. one study has just been re-munged), and drops studies
+# whose munged file no longer exists.
+
+import glob
+import gzip
+import heapq
+import json
+import os
+import shutil
+import sys
+from bisect import bisect_left, bisect_right
+
+default_pvalue_ceiling = 1e-3
+
+def main():
+
+    if len(sys.argv) < 2:
+        print "Please specify a command: build, update, or query."
+        sys.exit()
+
+    command = sys.argv[1]
+    if command == "build":
+        ceiling = default_pvalue_ceiling
+        if len(sys.argv) > 4:
+            ceiling = float(sys.argv[4])
+        build_index(sys.argv[2], sys.argv[3], ceiling)
+    elif command == "update":
+        update_index(sys.argv[2], sys.argv[3])
+    elif command == "query":
+        chrom, pos = sys.argv[3].split(":")
+        hits = query_position(sys.argv[2], chrom, int(pos), int(sys.argv[4]), float(sys.argv[5]))
+        print "study\ttrait\tchr\tsnp_pos\tpvalue"
+        for hit in hits:
+            print "\t".join([str(h) for h in hit])
+    else:
+        print "Unknown command:", command
+        sys.exit()
+
+def build_index(munge_config_file, index_dir, pvalue_ceiling=default_pvalue_ceiling):
+
+    with open(munge_config_file) as f:
+        config = json.load(f)
+
+    # Build the new index next to the old one and only swap it into place
+    # once it's complete, so a failed build leaves the old index usable.
+    # Refuse to touch any directory that doesn't look like one of ours.
+    final_dir = os.path.normpath(index_dir)
+    check_removable(final_dir)
+    index_dir = final_dir + ".tmp"
+    remove_index_dir(index_dir)
+    os.makedirs(index_dir)
+    open("{0}/{1}".format(index_dir, build_marker), "w").close()
+    tmp_dir = "{0}/tmp".format(index_dir)
+    os.makedirs(tmp_dir)
+
+    manifest = {"pvalue_ceiling": pvalue_ceiling, "studies": {}}
+
+    # Extract each study into its own sorted run for every chromosome first,
+    # so that we never need to hold the whole collection in memory at once.
+    runs = {}
+    for gwas_file in sorted(glob.glob("{0}/GWAS_*.txt.gz".format(config["output_base_dir"]))):
+        study_id = study_name(gwas_file)
+        print "Indexing", study_id
+
+        by_chrom = extract_study(gwas_file, study_id, pvalue_ceiling)
+        for chrom in by_chrom:
+            run_file = "{0}/{1}.chr{2}.txt.gz".format(tmp_dir, study_id, chrom)
+            write_partition(run_file, by_chrom[chrom])
+            runs.setdefault(chrom, []).append(run_file)
+        manifest["studies"][study_id] = study_entry(gwas_file, by_chrom)
+
+    # Then merge all runs for each chromosome into the final partition
+    for chrom in runs:
+        streams = [read_partition(r) for r in runs[chrom]]
+        write_partition(partition_file(index_dir, chrom), heapq.merge(*streams))
+
+    shutil.rmtree(tmp_dir)
+    write_manifest(index_dir, manifest)
+    os.remove("{0}/{1}".format(index_dir, build_marker))
+
+    old_dir = final_dir + ".old"
+    remove_index_dir(old_dir)
+    if os.path.exists(final_dir):
+        os.rename(final_dir, old_dir)
+    os.rename(index_dir, final_dir)
+    remove_index_dir(old_dir)
+
+# Written into an index while it's being built, so that a half-finished
+# build can be recognized and cleaned up
+build_marker = ".building"
+
+def check_removable(path):
+    if not os.path.exists(path):
+        return
+    if not os.path.isdir(path):
+        raise Exception("{0} exists and is not a directory".format(path))
+    contents = os.listdir(path)
+    if len(contents) > 0 and "manifest.json" not in contents and build_marker not in contents:
+        raise Exception("{0} is not empty and doesn't look like an index; refusing to replace it".format(path))
+
+def remove_index_dir(path):
+    check_removable(path)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+def update_index(munge_config_file, index_dir):
+
+    with open(munge_config_file) as f:
+        config = json.load(f)
+
+    manifest = load_manifest(index_dir)
+    pvalue_ceiling = manifest["pvalue_ceiling"]
+
+    gwas_files = {}
+    for gwas_file in glob.glob("{0}/GWAS_*.txt.gz".format(config["output_base_dir"])):
+        gwas_files[study_name(gwas_file)] = gwas_file
+
+    for study_id in sorted(manifest["studies"].keys()):
+        if study_id not in gwas_files:
+            print "Removing", study_id
+            update_study(index_dir, manifest, study_id, None)
+
+    for study_id in sorted(gwas_files.keys()):
+        entry = manifest["studies"].get(study_id)
+        stat = os.stat(gwas_files[study_id])
+        if entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            continue
+        print "Re-indexing", study_id
+        update_study(index_dir, manifest, study_id, gwas_files[study_id], pvalue_ceiling)
+
+    write_manifest(index_dir, manifest)
+
+def update_study(index_dir, manifest, study_id, gwas_file, pvalue_ceiling=None):
+
+    # Replace a single study's rows in every chromosome partition, leaving
+    # the rows for all other studies untouched.
+    if gwas_file is None:
+        by_chrom = {}
+    else:
+        by_chrom = extract_study(gwas_file, study_id, pvalue_ceiling)
+
+    chroms = set(by_chrom.keys())
+    if study_id in manifest["studies"]:
+        chroms |= set(manifest["studies"][study_id]["chroms"].keys())
+
+    for chrom in chroms:
+        part = partition_file(index_dir, chrom)
+        old_rows = (row for row in read_partition(part) if row[1] != study_id)
+        new_rows = by_chrom.get(chrom, [])
+        tmp = part + ".tmp"
+        write_partition(tmp, heapq.merge(old_rows, new_rows))
+        os.rename(tmp, part)
+
+    if gwas_file is None:
+        del manifest["studies"][study_id]
+    else:
+        manifest["studies"][study_id] = study_entry(gwas_file, by_chrom)
+
+def extract_study(gwas_file, study_id, pvalue_ceiling):
+
+    # Returns a dict of sorted (pos, study_id, trait_id, pvalue) lists,
+    # one for each chromosome, containing all SNPs below the ceiling.
+    by_chrom = {}
+    with gzip.open(gwas_file) as f:
+        header = f.readline().strip().split("\t")
+        trait_index = -1
+        if "trait" in header:
+            trait_index = header.index("trait")
+        pval_index = header.index("pvalue")
+        chr_index = header.index("chr")
+        snp_pos_index = header.index("snp_pos")
+
+        trait = study_id
+        for line in f:
+            data = line.strip().split("\t")
+            try:
+                pvalue = float(data[pval_index])
+            except:
+                continue
+            if pvalue >= pvalue_ceiling:
+                continue
+            if trait_index != -1:
+                trait = data[trait_index]
+            chrom = data[chr_index].replace("chr", "")
+            by_chrom.setdefault(chrom, []).append((int(data[snp_pos_index]), study_id, trait, pvalue))
+
+    for chrom in by_chrom:
+        by_chrom[chrom].sort()
+    return by_chrom
+
+def query_position(index_dir, chrom, pos, window, cutoff):
+    return query_positions(index_dir, [(chrom, pos)], window, cutoff)[(str(chrom).replace("chr", ""), pos)]
+
+def query_positions(index_dir, positions, window, cutoff):
+
+    # For a batch of (chr, pos) positions, return a dict mapping each position
+    # to a list of (study, trait, chr, snp_pos, pvalue) hits with p < cutoff
+    # lying within the window, most significant first. Each chromosome
+    # partition is read only once, no matter how many positions are given.
+    # The index only holds SNPs below the p-value ceiling it was built with,
+    # so a higher cutoff would silently miss hits.
+    pvalue_ceiling = load_manifest(index_dir)["pvalue_ceiling"]
+    if cutoff > pvalue_ceiling:
+        raise Exception("Cutoff {0} is above the index's p-value ceiling of {1}; rebuild the index with a higher ceiling".format(cutoff, pvalue_ceiling))
+
+    by_chrom = {}
+    for chrom, pos in positions:
+        by_chrom.setdefault(str(chrom).replace("chr", ""), set([])).add(pos)
+
+    results = {}
+    for chrom in by_chrom:
+        query_pos = sorted(by_chrom[chrom])
+        for pos in query_pos:
+            results[(chrom, pos)] = []
+
+        part = partition_file(index_dir, chrom)
+        if not os.path.exists(part):
+            continue
+
+        # Both the partition and the query positions are sorted, so stop as
+        # soon as we're past the last window.
+        last = query_pos[-1] + window
+        for row in read_partition(part):
+            if row[0] < query_pos[0] - window:
+                continue
+            if row[0] > last:
+                break
+            if row[3] >= cutoff:
+                continue
+            lo = bisect_left(query_pos, row[0] - window)
+            hi = bisect_right(query_pos, row[0] + window)
+            for pos in query_pos[lo:hi]:
+                results[(chrom, pos)].append((row[1], row[2], chrom, row[0], row[3]))
+
+    for key in results:
+        results[key].sort(key=lambda hit: hit[4])
+    return results
+
+def study_name(gwas_file):
+    name = os.path.basename(gwas_file)
+    return name[len("GWAS_"):-len(".txt.gz")]
+
+def study_entry(gwas_file, by_chrom):
+    stat = os.stat(gwas_file)
+    return {"file": gwas_file, "mtime": stat.st_mtime, "size": stat.st_size,
+            "chroms": dict([(c, len(by_chrom[c])) for c in by_chrom])}
+
+def partition_file(index_dir, chrom):
+    return "{0}/chr{1}.txt.gz".format(index_dir, chrom)
+
+def read_partition(filename):
+    if not os.path.exists(filename):
+        return
+    with gzip.open(filename) as f:
+        for line in f:
+            data = line.rstrip("\n").split("\t")
+            yield (int(data[0]), data[1], data[2], float(data[3]))
+
+def write_partition(filename, rows):
+    with gzip.open(filename, "wb") as w:
+        for row in rows:
+            w.write("{0}\t{1}\t{2}\t{3}\n".format(row[0], row[1], row[2], repr(row[3])))
+
+def load_manifest(index_dir):
+    with open("{0}/manifest.json".format(index_dir)) as f:
+        return json.load(f)
+
+def write_manifest(index_dir, manifest):
+    with open("{0}/manifest.json".format(index_dir), "w") as w:
+        json.dump(manifest, w, indent=4, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,574 @@
+#!/usr/bin/python
+
+# Long-running local server for tabix-style region queries.
+#
+# Calling the tabix command line tool over and over on the same munged
+# GWAS and eQTL files means every call pays again for starting a process,
+# loading the .tbi index, and decompressing the same BGZF blocks. This
+# server keeps the parsed indexes and the decompressed blocks in memory,
+# in an LRU cache with a fixed size limit, and answers batches of region
+# queries across many files over HTTP on a Unix socket.
+#
+# The server can read any file its owner can, so it only listens on a Unix
+# socket created with mode 0600, which no other user can connect to. It
+# is never exposed over TCP, where any user on the same node could use it.
+#
+# Usage:
+#
+#   python region_server.py [socket_path] [cache_size_mb]
+#
+# The socket path defaults to ~/.region_server.sock.
+#
+# Endpoints:
+#
+#   POST /query    {"queries": [{"file": ..., "region": "chr:start-end"}, ...]}
+#                  returns {"results": [[line, line, ...], ...]} with the
+#                  matching lines for each query, in the same order.
+#                  A query of the form {"file": ..., "header": true} returns
+#                  the first line of the file instead. If a query also has a
+#                  "trait", and the file has a trait directory from custom_munge.py,
+#                  only lines for that trait are returned.
+#   GET  /stats    cache hit rates and per-file query latency.
+#
+# To use the server from list_snps_to_test.py, add "region_server" with the
+# socket path (e.g. "/home/user/.region_server.sock") to the top level of the
+# overlap config file.
+
+import gzip
+import httplib
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import threading
+import time
+import traceback
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
+
+default_socket = os.path.expanduser("~/.region_server.sock")
+default_cache_mb = 1024
+
+class BlockCache:
+
+    # LRU cache of decompressed BGZF blocks and parsed tabix indexes, bounded
+    # by the total size in bytes of everything cached. Entries are keyed by the
+    # file's modification time and size as well as its name, so that nothing
+    # cached from an older version of a file is ever used once it changes.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.block_hits = 0
+        self.block_misses = 0
+        self.index_hits = 0
+        self.index_misses = 0
+        self.latency = {}
+
+    def index(self, filename):
+        key = ("index", filename, file_stamp(filename), file_stamp(filename + ".tbi"))
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        entry = load_tabix_index(filename)
+        self.put(key, entry, index_size(entry))
+        return entry
+
+    def block(self, filename, stamp, offset):
+        # stamp is the file's (mtime, size) from file_stamp, looked up once
+        # by the caller for each read rather than once per block
+        key = ("block", filename, stamp, offset)
+        block = self.get(key)
+        if block is not None:
+            return block
+        block = read_bgzf_block(filename, offset)
+        self.put(key, block, len(block[0]))
+        return block
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            if key[0] == "index":
+                if entry is None:
+                    self.index_misses += 1
+                else:
+                    self.index_hits += 1
+            else:
+                if entry is None:
+                    self.block_misses += 1
+                else:
+                    self.block_hits += 1
+        if entry is None:
+            return None
+        return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                old = self.entries.popitem(last=False)[1]
+                self.size -= old[1]
+
+    def record_latency(self, filename, seconds):
+        with self.lock:
+            stats = self.latency.setdefault(filename, [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+
+    def stats(self):
+        with self.lock:
+            files = {}
+            for filename in self.latency:
+                n, total = self.latency[filename]
+                files[filename] = {"queries": n, "mean_latency_ms": 1000.0 * total / n}
+            n_indexes = len([k for k in self.entries if k[0] == "index"])
+            return {"block_hits": self.block_hits,
+                    "block_misses": self.block_misses,
+                    "block_hit_rate": hit_rate(self.block_hits, self.block_misses),
+                    "index_hits": self.index_hits,
+                    "index_misses": self.index_misses,
+                    "index_hit_rate": hit_rate(self.index_hits, self.index_misses),
+                    "cached_blocks": len(self.entries) - n_indexes,
+                    "cached_indexes": n_indexes,
+                    "cached_bytes": self.size,
+                    "files": files}
+
+def file_stamp(filename):
+    stat = os.stat(filename)
+    return (stat.st_mtime, stat.st_size)
+
+def index_size(index):
+    # Rough estimate of the memory used by a parsed index, counting the
+    # Python objects for each bin, chunk and linear index entry
+    size = 1000
+    for ref in index["refs"]:
+        size += 100 * len(ref["bins"]) + 32 * len(ref["linear"])
+        for chunks in ref["bins"].values():
+            size += 150 * len(chunks)
+    return size
+
+def hit_rate(hits, misses):
+    if hits + misses == 0:
+        return 0.0
+    return hits * 1.0 / (hits + misses)
+
+def read_bgzf_block(filename, offset):
+
+    # Returns the decompressed data of the block starting at the given
+    # compressed offset, along with the offset of the following block.
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        header = f.read(12)
+        if len(header) < 12:
+            return ("", offset)
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = f.read(xlen)
+
+        # Find the BSIZE field in the gzip extra subfields
+        bsize = None
+        i = 0
+        while i < xlen:
+            slen = struct.unpack("<H", extra[i+2:i+4])[0]
+            if extra[i:i+2] == "BC":
+                bsize = struct.unpack("<H", extra[i+4:i+6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise Exception("{0} is not BGZF-compressed".format(filename))
+
+        cdata = f.read(bsize - xlen - 19)
+        return (zlib.decompress(cdata, -15), offset + bsize + 1)
+
+def load_tabix_index(filename):
+
+    with gzip.open(filename + ".tbi") as f:
+        data = f.read()
+
+    if data[:4] != "TBI\1":
+        raise Exception("Invalid tabix index for {0}".format(filename))
+    n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack("<8i", data[4:36])
+    names = data[36:36+l_nm].split("\0")[:n_ref]
+    pos = 36 + l_nm
+
+    refs = []
+    for r in range(n_ref):
+        bins = {}
+        n_bin = struct.unpack("<i", data[pos:pos+4])[0]
+        pos += 4
+        for b in range(n_bin):
+            bin, n_chunk = struct.unpack("<Ii", data[pos:pos+8])
+            pos += 8
+            chunks = struct.unpack("<{0}Q".format(2*n_chunk), data[pos:pos+16*n_chunk])
+            pos += 16 * n_chunk
+            bins[bin] = zip(chunks[0::2], chunks[1::2])
+        n_intv = struct.unpack("<i", data[pos:pos+4])[0]
+        pos += 4
+        linear = struct.unpack("<{0}Q".format(n_intv), data[pos:pos+8*n_intv])
+        pos += 8 * n_intv
+        refs.append({"bins": bins, "linear": linear})
+
+    return {"names": dict([(n, i) for i, n in enumerate(names)]), "refs": refs,
+            "col_seq": col_seq, "col_beg": col_beg, "col_end": col_end,
+            "zero_based": (fmt & 0x10000) != 0, "meta": chr(meta)}
+
+def reg2bins(beg, end):
+    # Standard binning scheme shared by tabix and BAM indexes
+    bins = [0]
+    end -= 1
+    for shift, base in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(range(base + (beg >> shift), base + (end >> shift) + 1))
+    return bins
+
+def read_lines(cache, filename, voffset, stop):
+
+    # Yield the lines starting at virtual offsets from voffset up to (but
+    # not including) stop.
+    stamp = file_stamp(filename)
+    coffset = voffset >> 16
+    uoffset = voffset & 0xFFFF
+    data, next_offset = cache.block(filename, stamp, coffset)
+    partial = ""
+    line_start = voffset
+    while True:
+        if uoffset >= len(data):
+            if next_offset == coffset:
+                break
+            coffset = next_offset
+            uoffset = 0
+            data, next_offset = cache.block(filename, stamp, coffset)
+            if data == "":
+                break
+            continue
+        if partial == "":
+            line_start = (coffset << 16) | uoffset
+            if line_start >= stop:
+                break
+        end = data.find("\n", uoffset)
+        if end == -1:
+            partial += data[uoffset:]
+            uoffset = len(data)
+            continue
+        yield partial + data[uoffset:end]
+        partial = ""
+        uoffset = end + 1
+    if partial != "":
+        yield partial
+
+def query_region(cache, filename, region):
+
+    # Region is in tabix format, "chr:start-end", 1-based and inclusive
+    index = cache.index(filename)
+    seq, span = region.rsplit(":", 1)
+    # The start may be negative if a window extends past the chromosome start
+    beg, end = [int(x) for x in span.rsplit("-", 1)]
+    beg = max(beg - 1, 0)
+    if seq not in index["names"] or end <= beg:
+        return []
+    ref = index["refs"][index["names"][seq]]
+
+    min_off = 0
+    if (beg >> 14) < len(ref["linear"]):
+        min_off = ref["linear"][beg >> 14]
+
+    chunks = []
+    for bin in reg2bins(beg, end):
+        for chunk in ref["bins"].get(bin, []):
+            if chunk[1] > min_off:
+                chunks.append((max(chunk[0], min_off), chunk[1]))
+    chunks.sort()
+
+    # Merge overlapping chunks so no line is read twice
+    merged = []
+    for chunk in chunks:
+        if len(merged) > 0 and chunk[0] <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], chunk[1]))
+        else:
+            merged.append(chunk)
+
+    matches = []
+    for chunk in merged:
+        for line in read_lines(cache, filename, chunk[0], chunk[1]):
+            if line.startswith(index["meta"]):
+                continue
+            fields = line.split("\t")
+            try:
+                if fields[index["col_seq"]-1] != seq:
+                    continue
+                line_beg = int(fields[index["col_beg"]-1])
+                line_end = line_beg + 1
+                if index["col_end"] > 0:
+                    line_end = int(fields[index["col_end"]-1])
+            except:
+                # Header or malformed line
+                continue
+            if not index["zero_based"]:
+                line_beg -= 1
+            if line_beg >= end:
+                break
+            if line_end > beg:
+                matches.append(line)
+    return matches
+
+def load_trait_directory(gwas_file):
+
+    # Multi-trait files from custom_munge.py come with a copy sorted by trait,
+    # and a directory "<gwas_file>.traits" of where each trait and chromosome
+    # starts and ends in that copy. Returns None if there is no directory, or
+    # if it was written for a different version of the GWAS file (e.g. the
+    # study has since been re-munged without writing a new directory).
+    if not os.path.exists(gwas_file + ".traits"):
+        return None
+    mtime = os.path.getmtime(gwas_file + ".traits")
+    if gwas_file not in trait_directories or trait_directories[gwas_file][0] != mtime:
+        with open(gwas_file + ".traits") as f:
+            directory = json.load(f)
+        directory["file"] = os.path.join(os.path.dirname(gwas_file), directory["file"])
+        trait_directories[gwas_file] = (mtime, directory)
+    directory = trait_directories[gwas_file][1]
+    stat = os.stat(gwas_file)
+    if directory.get("gwas_mtime") != stat.st_mtime or directory.get("gwas_size") != stat.st_size:
+        return None
+    return directory
+
+trait_directories = {}
+
+def read_trait_lines(cache, gwas_file, trait, chrom=None):
+
+    # Yield all lines for one trait, or for one chromosome within that trait
+    directory = load_trait_directory(gwas_file)
+    entry = directory["traits"].get(trait)
+    if entry is not None and chrom is not None:
+        entry = entry["chroms"].get(chrom)
+    if entry is None:
+        return
+    for line in read_lines(cache, directory["file"], entry["start"], entry["end"]):
+        yield line
+
+def query_trait_region(cache, gwas_file, trait, region):
+
+    # Like query_region, but only returns lines for a single trait
+    directory = load_trait_directory(gwas_file)
+    seq, span = region.rsplit(":", 1)
+    beg, end = [int(x) for x in span.rsplit("-", 1)]
+    entry = directory["traits"].get(trait)
+    if entry is None or seq not in entry["chroms"]:
+        return []
+    entry = entry["chroms"][seq]
+    pos_index = directory["columns"]["snp_pos"]
+
+    # Start from the last checkpoint before the region
+    checkpoints = [c[0] for c in entry["checkpoints"]]
+    i = bisect_left(checkpoints, beg)
+    start = entry["start"]
+    if i > 0:
+        start = entry["checkpoints"][i-1][1]
+
+    matches = []
+    for line in read_lines(cache, directory["file"], start, entry["end"]):
+        pos = int(line.split("\t")[pos_index])
+        if pos > end:
+            break
+        if pos >= beg:
+            matches.append(line)
+    return matches
+
+def read_header(cache, filename):
+    for line in read_lines(cache, filename, 0, 1):
+        return line
+    return ""
+
+def run_queries(cache, queries):
+    results = []
+    for query in queries:
+        start = time.time()
+        if query.get("header", False):
+            results.append([read_header(cache, query["file"])])
+        elif "trait" in query and load_trait_directory(query["file"]) is not None:
+            results.append(query_trait_region(cache, query["file"], query["trait"], query["region"]))
+        else:
+            results.append(query_region(cache, query["file"], query["region"]))
+        cache.record_latency(query["file"], time.time() - start)
+    return results
+
+class RegionRequestHandler(BaseHTTPRequestHandler):
+
+    # Keep connections open between requests, so clients don't have to
+    # reconnect for every batch
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.respond(200, self.server.cache.stats())
+        else:
+            self.respond(404, {"error": "Unknown path: " + self.path})
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length", 0))
+        body = self.rfile.read(length)
+        if self.path != "/query":
+            self.respond(404, {"error": "Unknown path: " + self.path})
+            return
+        try:
+            request = json.loads(body)
+            self.respond(200, {"results": run_queries(self.server.cache, request["queries"])})
+        except Exception:
+            self.respond(500, {"error": traceback.format_exc()})
+
+    def respond(self, code, body):
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't print a line for every request
+        pass
+
+class RegionServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Create the socket so that only its owner can ever connect to it
+        old_umask = os.umask(0177)
+        try:
+            UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+        os.chmod(self.server_address, 0600)
+
+def socket_in_use(path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client.close()
+
+# Client functions, for use from other scripts
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+client_connections = threading.local()
+
+def server_connection(server):
+    # One open connection per thread (and per process, since pool workers
+    # are forked after the parent may already have connected)
+    connections = getattr(client_connections, "connections", None)
+    if connections is None or connections[0] != os.getpid():
+        connections = (os.getpid(), {})
+        client_connections.connections = connections
+    if server not in connections[1]:
+        connections[1][server] = UnixHTTPConnection(server)
+    return connections[1][server]
+
+def remote_query(server, queries):
+    # File paths are resolved by the server, so send them as absolute paths
+    for query in queries:
+        query["file"] = os.path.abspath(query["file"])
+    body = json.dumps({"queries": queries})
+
+    # The server may have closed an idle connection, so try once more on a
+    # new connection if the request fails. Queries have no side effects, so
+    # repeating one is safe.
+    for attempt in range(2):
+        connection = server_connection(server)
+        try:
+            connection.request("POST", "/query", body, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            reply = json.loads(response.read())
+            break
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if attempt == 1:
+                raise
+    if response.status != 200:
+        raise Exception("Region server error: {0}".format(reply["error"]))
+    return reply["results"]
+
+def remote_tabix(server, filename, region):
+    # Drop-in replacement for the output of "tabix filename region"
+    lines = remote_query(server, [{"file": filename, "region": region}])[0]
+    return "".join([line.encode("utf-8") + "\n" for line in lines])
+
+def remote_trait_tabix(server, filename, region, traits):
+    results = remote_query(server, [{"file": filename, "region": region, "trait": t} for t in traits])
+    return "".join([line.encode("utf-8") + "\n" for lines in results for line in lines])
+
+def remote_header(server, filename):
+    return remote_query(server, [{"file": filename, "header": True}])[0][0].encode("utf-8")
+
+def remote_tabix_batch(server, filename, regions, traits=None):
+    # The header of a file and the "tabix filename region" output for each of
+    # several regions, all in a single request. If traits are given, only
+    # lines for those traits are returned for each region.
+    queries = [{"file": filename, "header": True}]
+    for region in regions:
+        if traits is None:
+            queries.append({"file": filename, "region": region})
+        else:
+            queries.extend([{"file": filename, "region": region, "trait": t} for t in traits])
+    results = remote_query(server, queries)
+
+    per_region = 1 if traits is None else len(traits)
+    outputs = []
+    for i in range(len(regions)):
+        lines = [line for lines in results[1+i*per_region:1+(i+1)*per_region] for line in lines]
+        outputs.append("".join([line.encode("utf-8") + "\n" for line in lines]))
+    return results[0][0].encode("utf-8"), outputs
+
+def main():
+
+    socket_path = default_socket
+    if len(sys.argv) > 1:
+        socket_path = os.path.abspath(sys.argv[1])
+    cache_mb = default_cache_mb
+    if len(sys.argv) > 2:
+        cache_mb = int(sys.argv[2])
+
+    # Clean up the socket left behind by a server that has exited, but
+    # don't take over one that's still running
+    if os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            print socket_path, "exists and is not a socket."
+            sys.exit()
+        if socket_in_use(socket_path):
+            print "A server is already running on", socket_path
+            sys.exit()
+        os.remove(socket_path)
+
+    server = RegionServer(socket_path, RegionRequestHandler)
+    server.cache = BlockCache(cache_mb * 1024 * 1024)
+    print "Serving region queries on {0} with a {1}MB block cache".format(socket_path, cache_mb)
+
+    # Remove the socket on exit, including when killed by a job scheduler
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(socket_path)
+
+if __name__ == "__main__":
+    main()